@@ -3,13 +3,20 @@ Script to downsample from our training set.
 """
 
 import sys
-import random
+import itertools
+import numpy as np
 
 infile = sys.argv[1]
 outfile = sys.argv[2]
 percent_to_keep = int(sys.argv[3])
 
-with open(infile, 'r') as big, open(outfile, 'w') as out:
-	for example in big:
-		if (random.randint(0, 100) < percent_to_keep):
-			out.write(example)
+# number of lines handled (and written) at a time
+block_lines = 8192
+
+rng = np.random.default_rng()
+
+with open(infile, 'r') as big, open(outfile, 'w', buffering=1 << 20) as out:
+	for examples in iter(lambda: list(itertools.islice(big, block_lines)), []):
+		# draw the keep/drop decision for every example of the block in one call
+		keep = rng.integers(0, 101, len(examples)) < percent_to_keep
+		out.writelines([example for example, k in zip(examples, keep) if k])
@@ -5,10 +5,23 @@ and inserting new lines between tweets.
 
 import sys
 
+EOS = '<eos>'
+CHUNK_SIZE = 1 << 20
+
+def write_tweet(out, tweet):
+	# generated characters are separated by a space (or a new line),
+	# so drop the separator following <eos> and keep every other character
+	if tweet[:1] in (' ', '\n'):
+		tweet = tweet[1:]
+	out.write(tweet[::2] + '\n')
+
 with open(sys.argv[1], 'r') as f, open(sys.argv[2], 'w') as out:
-	for tweet in f.read().split('<eos>'):
-		tweet_char = list(tweet)
-		if (tweet_char[0] is ' '):
-			out.write(''.join(list(tweet)[1::2]) + '\n')
-		else:
-			out.write(''.join(list(tweet)[::2]) + '\n')
+	# stream the file in chunks instead of reading it all at once; whatever
+	# follows the last <eos> of a chunk is carried over to the next one
+	pending = ''
+	for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
+		tweets = (pending + chunk).split(EOS)
+		pending = tweets.pop()
+		for tweet in tweets:
+			write_tweet(out, tweet)
+	write_tweet(out, pending)
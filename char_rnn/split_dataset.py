@@ -4,8 +4,13 @@ the dataset into train/valid/test.
 """
 
 import csv
+import io
+import os
 import sys
-import random
+import shutil
+import tempfile
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 
 test_percent = 10
 valid_percent = 10
@@ -14,17 +19,104 @@ train_file = 'data/train.txt'
 valid_file = 'data/valid.txt'
 test_file = 'data/test.txt'
 
-with open(train_file, 'w') as train, open(valid_file, 'w') as valid, open(test_file, 'w') as test:
-	for filename in sys.argv[1:]:
-		with open(filename, 'r') as csvfile:
-			reader = csv.DictReader(csvfile)
-			for row in reader:
-				# only keep the tweets not the metadata
-				tweet = row['tweet'] + '\n'
-				rand = random.randint(0, 100)
-				if (rand < test_percent):
-					test.write(tweet)
-				elif (rand < test_percent + valid_percent):
-					valid.write(tweet)
-				else:
-					train.write(tweet)
+# number of tweets handled (and written) at a time
+block_lines = 8192
+
+# set to an int to make the split reproducible
+seed = None
+
+def write_split(tweets, rng, train, valid, test):
+	"""
+	Draws the split for a block of tweets in one call and writes each part.
+	"""
+	rand = rng.integers(0, 101, len(tweets))
+	test.writelines([tweets[i] for i in np.flatnonzero(rand < test_percent)])
+	valid.writelines([tweets[i] for i in np.flatnonzero((rand >= test_percent) & (rand < test_percent + valid_percent))])
+	train.writelines([tweets[i] for i in np.flatnonzero(rand >= test_percent + valid_percent)])
+
+def split_file(filename, file_seed):
+	"""
+	Splits the tweets of one csv file into train/valid/test, writing each
+	part to a temporary file. Returns the paths of the three parts.
+	"""
+	rng = np.random.default_rng(file_seed)
+	parts = []
+	try:
+		with io.open(filename, 'rb', buffering=1 << 20) as raw, \
+				io.TextIOWrapper(raw, encoding='utf-8', newline='') as csvfile:
+			# look up the tweet column once from the header instead of
+			# building a dict for every row (an empty file has no header;
+			# it is already at its end, so its parts just stay empty)
+			header = next(csv.reader(csvfile), None)
+			tweet_col = 0 if header is None else header.index('tweet')
+			for _ in range(3):
+				parts.append(tempfile.NamedTemporaryFile('w', suffix='.txt', dir=os.path.dirname(train_file),
+						buffering=1 << 20, delete=False))
+			# a single csv reader for the quoted lines: it is handed each such
+			# line and reads on from the file itself when a quoted field
+			# spans several lines
+			pushed = []
+			def quoted_lines():
+				while True:
+					line = pushed.pop() if pushed else csvfile.readline()
+					if not line:
+						return
+					yield line
+			quoted_reader = csv.reader(quoted_lines())
+			with parts[0] as train, parts[1] as valid, parts[2] as test:
+				tweets = []
+				for line in csvfile:
+					# skip blank lines, which csv treats as empty rows
+					if not line.rstrip('\r\n'):
+						continue
+					if '"' not in line:
+						# fast path: without quotes no field can contain a comma or
+						# a line break, so a plain split parses the row exactly
+						row = line.rstrip('\r\n').split(',', tweet_col + 1)
+					else:
+						# slow path: let csv deal with the quoting
+						pushed.append(line)
+						row = next(quoted_reader)
+					# skip blank or truncated rows
+					if len(row) <= tweet_col:
+						continue
+					# only keep the tweets not the metadata
+					tweets.append(row[tweet_col] + '\n')
+					if len(tweets) == block_lines:
+						write_split(tweets, rng, train, valid, test)
+						tweets.clear()
+				write_split(tweets, rng, train, valid, test)
+	except BaseException:
+		# don't leave partial parts behind in the data directory
+		for part in parts:
+			part.close()
+			os.remove(part.name)
+		raise
+	return [part.name for part in parts]
+
+if __name__ == '__main__':
+	filenames = sys.argv[1:]
+	# every file gets its own independent random stream, all derived from
+	# one root seed
+	seeds = np.random.SeedSequence(seed).spawn(len(filenames))
+	with ProcessPoolExecutor() as executor:
+		futures = [executor.submit(split_file, f, s) for f, s in zip(filenames, seeds)]
+
+	# if any file failed, remove the parts the other workers wrote
+	failed = [future.exception() for future in futures if future.exception() is not None]
+	results = [future.result() for future in futures if future.exception() is None]
+	if failed:
+		for paths in results:
+			for path in paths:
+				os.remove(path)
+		raise failed[0]
+
+	# concatenate the per-file parts, in the order the files were given
+	with open(train_file, 'w', buffering=1 << 20) as train, \
+			open(valid_file, 'w', buffering=1 << 20) as valid, \
+			open(test_file, 'w', buffering=1 << 20) as test:
+		for paths in results:
+			for out, path in zip((train, valid, test), paths):
+				with open(path, 'r') as part:
+					shutil.copyfileobj(part, out)
+				os.remove(path)
@@ -3,7 +3,8 @@ Script to split the username dataset into train/valid/test sets.
 """
 
 import sys
-import random
+import itertools
+import numpy as np
 
 test_percent = 10
 valid_percent = 10
@@ -12,15 +13,19 @@ train_file = 'data/train.txt'
 valid_file = 'data/valid.txt'
 test_file = 'data/test.txt'
 
-with open(train_file, 'w') as train, open(valid_file, 'w') as valid, open(test_file, 'w') as test:
+# number of lines handled (and written) at a time
+block_lines = 8192
+
+rng = np.random.default_rng()
+
+with open(train_file, 'w', buffering=1 << 20) as train, \
+		open(valid_file, 'w', buffering=1 << 20) as valid, \
+		open(test_file, 'w', buffering=1 << 20) as test:
 	for filename in sys.argv[1:]:
 		with open(filename, 'r') as reader:
-			for row in reader:
-				row = row + '\n'
-				rand = random.randint(0, 100)
-				if (rand < test_percent):
-					test.write(row)
-				elif (rand < test_percent + valid_percent):
-					valid.write(row)
-				else:
-					train.write(row)
+			for rows in iter(lambda: [row + '\n' for row in itertools.islice(reader, block_lines)], []):
+				# draw the split for every row of the block in one call
+				rand = rng.integers(0, 101, len(rows))
+				test.writelines([rows[i] for i in np.flatnonzero(rand < test_percent)])
+				valid.writelines([rows[i] for i in np.flatnonzero((rand >= test_percent) & (rand < test_percent + valid_percent))])
+				train.writelines([rows[i] for i in np.flatnonzero(rand >= test_percent + valid_percent)])
@@ -30,6 +30,8 @@
 
 
 import os
+import hashlib
+import pathlib
 
 #if using Theano with GPU
 #os.environ["THEANO_FLAGS"] = "mode=FAST_RUN,device=gpu,floatX=float32"
@@ -37,9 +39,20 @@ import os
 import random
 import numpy as np
 from glob import glob
-from keras.models import Sequential
-from keras.layers.recurrent import LSTM
-from keras.layers.core import Dense, Activation, Dropout
+from numba import njit, prange
+import tensorflow as tf
+from tensorflow.keras import mixed_precision
+from tensorflow.keras.models import Sequential
+from tensorflow.keras.layers import Input, LSTM, Dense, Activation, Dropout, Embedding
+from tensorflow.keras.optimizers import Adam
+
+# on a GPU, train in mixed precision: the weights stay float32 but the
+# computations (and the activations passed between layers) run in float16,
+# halving memory traffic and using tensor cores where available, while the
+# output layer below is kept in float32 for numerical stability.
+# on a CPU float16 compute is much slower, so we stay in float32 there
+if tf.config.list_physical_devices('GPU'):
+    mixed_precision.set_global_policy('mixed_float16')
 
 
 # In[2]:
@@ -61,7 +74,9 @@ text_files[0:5]
 
 
 # let us create a long string variable text
-text = '\n'.join([open(f, 'r').read() for f in text_files])
+# (the files are read as raw bytes and decoded once, after joining them)
+chunks = [pathlib.Path(f).read_bytes() for f in text_files]
+text = b'\n'.join(chunks).decode('utf-8', 'replace')
 text[0:500]
 
 
@@ -77,7 +92,13 @@ print(len(text))
 
 # extract all (unique) characters
 # these are our "categories" or "labels". We want to predict the next character from the past few (e.g 20) characters
-chars = list(set(text))
+# (sorted, so that every run gives each character the same label)
+# numpy finds them from the array of the text's code points, which is much
+# faster than pushing every single character through a python set: counting
+# how often each code point occurs is a single pass over the text (no sort),
+# and the ones that occur at all come out already in order
+text_codes = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32)
+chars = [chr(c) for c in np.flatnonzero(np.bincount(text_codes))]
 print(chars)
 
 
@@ -96,18 +117,32 @@ max_len = 8
 
 
 # Now we'll define our RNN. Keras makes this trivial:
+# 
+# Rather than feeding the network one-hot vectors directly, we feed it the integer label of each character and let a (frozen) identity `Embedding` layer expand the labels into one-hot vectors. This is mathematically the same input, but the training data only needs to store one number per character instead of a whole vector.
 
 # In[9]:
 
 
 model = Sequential()
-model.add(LSTM(512, return_sequences=True, input_shape=(max_len, len(chars))))
+model.add(Input(shape=(max_len,), dtype='int32'))
+model.add(Embedding(len(chars), len(chars),
+                    embeddings_initializer='identity', trainable=False))
+# the LSTM arguments are spelled out so that both layers are guaranteed to
+# stay on the fast (fused) CuDNN kernel when training on a GPU
+model.add(LSTM(512, return_sequences=True,
+               activation='tanh', recurrent_activation='sigmoid',
+               recurrent_dropout=0.0, unroll=False, use_bias=True))
 model.add(Dropout(0.2))
-model.add(LSTM(512, return_sequences=False))
+model.add(LSTM(512, return_sequences=False,
+               activation='tanh', recurrent_activation='sigmoid',
+               recurrent_dropout=0.0, unroll=False, use_bias=True))
 model.add(Dropout(0.2))
-model.add(Dense(len(chars)))
-model.add(Activation('softmax'))
-model.compile(loss='categorical_crossentropy', optimizer='rmsprop')
+model.add(Dense(len(chars), dtype='float32'))
+model.add(Activation('softmax', dtype='float32'))
+# Adam rather than rmsprop; the training step is deliberately not compiled
+# with XLA (jit_compile), since XLA can't compile the fused CuDNN LSTM kernel
+# and would either be skipped or push the LSTMs off the fast path
+model.compile(loss='sparse_categorical_crossentropy', optimizer=Adam(learning_rate=1e-3))
 
 
 # In[10]:
@@ -120,7 +155,7 @@ model.summary()
 # 
 # We use the _softmax_ activation function on our output layer - this function is used for categorical output. It turns the output into a probability distribution over the categories (i.e. it makes the values the network outputs sum to 1). So the network will essentially tell us how strongly it feels about each character being the next one.
 # 
-# The categorical cross-entropy loss the standard loss function for multilabel classification, which basically penalizes the network more the further off it is from the correct label.
+# The categorical cross-entropy loss the standard loss function for multilabel classification, which basically penalizes the network more the further off it is from the correct label. (We use its "sparse" variant, which takes the correct label itself rather than a one-hot vector of it.)
 # 
 # We use dropout here to prevent overfitting - we don't want the network to just return things already in the text, we want it to have some wiggle room and create novelty! Dropout is a technique where, in training, some percent (here, 20%) of random neurons of the associated layer are "turned off" for that epoch. This prevents overfitting by preventing the network from relying on particular neurons.
 # 
@@ -174,24 +209,23 @@ print(true_output_3)
 
 
 step = 3
-inputs = []
-outputs = []
-for i in range(0, len(text) - max_len, step):
-    inputs.append(text[i:i+max_len])
-    outputs.append(text[i+max_len])
+# we only need to know where each input starts: input i is
+# text[starts[i]:starts[i]+max_len] and its output is text[starts[i]+max_len],
+# so there's no need to copy every one of them out into its own string
+starts = np.arange(0, len(text) - max_len, step)
 
 
 # In[15]:
 
 
-print(len(inputs),len(outputs))
+print(len(starts))
 
 
 # In[16]:
 
 
 # Let us see a specific example for the input text and the output
-print(inputs[1995], outputs[1995])
+print(text[starts[1995]:starts[1995] + max_len], text[starts[1995] + max_len])
 
 
 # We also need to map each character to a label and create a reverse mapping to use later:
@@ -202,6 +236,23 @@ print(inputs[1995], outputs[1995])
 char_labels = {ch:i for i, ch in enumerate(chars)}
 labels_char = {i:ch for i, ch in enumerate(chars)}
 
+# the same mapping as a lookup table indexed by code point (-1 for characters
+# we haven't seen), so a whole string can be translated into labels with one
+# numpy indexing operation instead of a dict lookup per character
+label_lut = np.full(max(ord(ch) for ch in chars) + 1, -1, dtype=np.int32)
+for ch, i in char_labels.items():
+    label_lut[ord(ch)] = i
+
+def encode(s):
+    """translates a string into an array of character labels
+    (-1 for any character not in the training text)"""
+    codes = np.frombuffer(s.encode('utf-32-le'), dtype=np.uint32)
+    labels = np.full(len(codes), -1, dtype=np.int32)
+    # code points beyond the end of the table can't be in the training text
+    known = codes < len(label_lut)
+    labels[known] = label_lut[codes[known]]
+    return labels
+
 
 # In[18]:
 
@@ -254,14 +305,28 @@ example_char_labels = {
 # 
 # ![A 3-tensor of training examples](../assets/rnn_3tensor.png)
 # 
-# And the outputs for each example are each a one-hot vector (i.e. a single character). With that in mind:
+# Since every row of that matrix has exactly one 1 in it, we don't actually need to store the whole 3-tensor: the `Embedding` layer at the start of our model turns the labels into one-hot vectors for us, so each input example is just the list of its character labels, e.g. `[2, 0, 1, 4, 3, 0, 1]` for the example above.
+# 
+# And the outputs for each example are each a one-hot vector (i.e. a single character) - or, again, just the label of that character, since the sparse cross-entropy loss takes labels directly. With that in mind:
+# 
+# Building these tensors only depends on the text files, `max_len`, `step` and our labels, so after the first run we save them to disk (in a directory named after a hash of those settings) and on later runs just memory-map them back in.
 
 # In[21]:
 
 
-# using bool to reduce memory usage
-X = np.zeros((len(inputs), max_len, len(chars)), dtype=np.bool)
-y = np.zeros((len(inputs), len(chars)), dtype=np.bool)
+# ('labels' marks the layout of the cached arrays, so caches from older
+# versions of this notebook aren't picked up)
+cache_key = repr(('labels', text_files, [os.path.getmtime(f) for f in text_files], max_len, step, chars))
+cache_dir = 'dataset_cache_' + hashlib.sha1(cache_key.encode('utf-8')).hexdigest()[:16]
+cached = all(os.path.exists(os.path.join(cache_dir, name)) for name in ('X.npy', 'y.npy'))
+
+if cached:
+    X = np.load(os.path.join(cache_dir, 'X.npy'), mmap_mode='r')
+    y = np.load(os.path.join(cache_dir, 'y.npy'), mmap_mode='r')
+else:
+    # store only the label of each character to reduce memory usage
+    X = np.zeros((len(starts), max_len), dtype=np.int16)
+    y = np.zeros(len(starts), dtype=np.int16)
 
 print(X.shape)
 print(y.shape)
@@ -270,32 +335,50 @@ print(y.shape)
 # In[22]:
 
 
-# set the appropriate indices to 1 in each one-hot vector
-for i, example in enumerate(inputs):
-    for t, char in enumerate(example):
-        X[i, t, char_labels[char]] = 1
-    y[i, char_labels[outputs[i]]] = 1
+# fill in the label of each input character and of each output character
+# rather than looping over every example in python, we do it in a function
+# compiled with numba, which looks up the labels straight from the text's
+# code points and spreads the examples over all the cpu cores
+@njit(parallel=True, cache=True)
+def build_dataset(codes, lut, starts, max_len, X, y):
+    for k in prange(len(starts)):
+        s = starts[k]
+        for t in range(max_len):
+            X[k, t] = lut[codes[s + t]]
+        y[k] = lut[codes[s + max_len]]
+
+if not cached:
+    build_dataset(text_codes, label_lut, starts, max_len, X, y)
+
+    # write each array to a temporary file and only then move it into place,
+    # so an interrupted run never leaves a truncated file in the cache
+    os.makedirs(cache_dir, exist_ok=True)
+    for name, arr in (('X.npy', X), ('y.npy', y)):
+        path = os.path.join(cache_dir, name)
+        with open(path + '.tmp', 'wb') as f:
+            np.save(f, arr)
+        os.replace(path + '.tmp', path)
 
 
 # In[23]:
 
 
-#Let us plot a specific sentence
-plt.imshow(X[1345,:,:])
+#Let us plot a specific sentence (expanding its labels back into one-hot vectors)
+plt.imshow(np.eye(len(chars), dtype=bool)[X[1345]])
 
 
 # In[24]:
 
 
 # Let us look at an example input
-print(X[13,15,:])
+print(X[13,:])
 
 
 # In[25]:
 
 
 # Let us look at an example label
-print(y[230,:])
+print(y[230])
 
 
 # Now that we have our training data, we can start training. Keras also makes this easy:
@@ -329,13 +412,28 @@ print(np.random.choice(choices, p=dist))
 
 
 # A function to draw samples from a Boltzmann distribution
+# (the log/exp/normalize/search steps are compiled with numba into one loop;
+# the uniform draws come from numpy's own generator, because numba keeps a
+# separate one that np.random.seed doesn't affect)
+@njit(cache=True)
+def _sample(probs, temperature, u):
+    n = probs.shape[1]
+    out = np.empty(probs.shape[0], dtype=np.int32)
+    for r in range(probs.shape[0]):
+        a = np.log(probs[r].astype(np.float64))/temperature
+        # subtracting the max keeps exp from overflowing at low temperatures
+        a -= a.max()
+        # inverse-CDF sampling: pick the first index whose cumulative
+        # (unnormalized) probability exceeds a uniform draw
+        cdf = np.cumsum(np.exp(a))
+        idx = np.searchsorted(cdf, u[r]*cdf[-1], side='right')
+        out[r] = min(idx, n - 1)
+    return out
+
 def sample(probs, temperature):
-    """samples an index from a vector of probabilities
-    (this is not the most efficient way but is more robust)"""
-    a = np.log(probs)/temperature
-    dist = np.exp(a)/np.sum(np.exp(a))
-    choices = range(len(probs))
-    return np.random.choice(choices, p=dist)
+    """samples an index from each row of a matrix of probabilities
+    (one row per text being generated)"""
+    return _sample(probs, temperature, np.random.random(len(probs)))
 
 
 # In[29]:
@@ -367,16 +465,15 @@ print(sentence)
 
 # generate the input tensor
 # from the last max_len characters generated so far
-x = np.zeros((1, max_len, len(chars)))
-for t, char in enumerate(sentence):
-    x[0, t, char_labels[char]] = 1.
+# (int32 is what the Embedding layer works with, so nothing gets cast)
+x = encode(sentence)[None, :]
 print(x.shape)
 
 
 # In[32]:
 
 
-plt.imshow(x[0,:,:])
+plt.imshow(np.eye(len(chars), dtype=bool)[x[0]])
 
 
 # In[33]:
@@ -392,48 +489,97 @@ print(probs)
 print(probs.shape)
 
 
+# Calling `model.predict` on the whole `max_len` window for every single character we generate is slow: most of the work re-processes characters the network has already seen. Instead, we build a twin of our network for generation which takes just _one_ character at a time, together with the LSTM hidden and cell states from the previous step, and returns the new states alongside its prediction. It shares its weights with `model`, and it lets us generate several texts in parallel (one per row of the batch).
+# 
+# There is one catch: our network was only ever trained on windows of `max_len` characters, starting from an empty (zero) state. If we just kept carrying the states forward, every prediction would depend on _everything_ generated so far, which is not what the network learned. So every `max_len` characters we reset the states and warm them up again on the last `max_len` characters. Right after a reset the prediction is exactly what `model` would give for that window; in between, the network sees between `max_len` and `2 * max_len - 1` characters of context, which is still close to what it was trained on while re-processing each character only about twice instead of `max_len` times.
+
 # In[35]:
 
 
+from tensorflow.keras.models import Model
+
+# the LSTM states are carried in the same dtype the layers compute in
+state_dtype = mixed_precision.global_policy().compute_dtype
+
+char_in = Input(shape=(1,), dtype='int32')
+states_in = [Input(shape=(512,), dtype=state_dtype) for _ in range(4)]
+h = Embedding(len(chars), len(chars), trainable=False)(char_in)
+h, h1, c1 = LSTM(512, return_sequences=True, return_state=True,
+                 activation='tanh', recurrent_activation='sigmoid',
+                 recurrent_dropout=0.0, unroll=False, use_bias=True)(h, initial_state=states_in[:2])
+h, h2, c2 = LSTM(512, return_sequences=False, return_state=True,
+                 activation='tanh', recurrent_activation='sigmoid',
+                 recurrent_dropout=0.0, unroll=False, use_bias=True)(h, initial_state=states_in[2:])
+h = Dense(len(chars), dtype='float32')(h)
+probs_out = Activation('softmax', dtype='float32')(h)
+inf_model = Model([char_in] + states_in, [probs_out, h1, c1, h2, c2])
+
+# calling the model directly inside a tf.function skips the per-call
+# overhead of model.predict (no XLA here: it can't compile the fused CuDNN
+# LSTM kernel; reduce_retracing avoids a new trace for every batch size)
+@tf.function(reduce_retracing=True)
+def predict_step(x, states):
+    return inf_model([x] + states, training=False)
+
+
+# In[36]:
+
+
 # Based on these ideas, let us create a generate function
-def generate(temperature=0.35, seed=None, num_chars=100):
-    predict_more=lambda x: len(x) < num_chars
-    
+def generate_batch(temperature=0.35, seed=None, num_chars=100, num_samples=1):
+    """generates num_samples texts of num_chars characters in parallel"""
     if seed is not None and len(seed) < max_len:
         raise Exception('Seed text must be at least {} chars long'.format(max_len))
 
-    # if no seed text is specified, randomly select a chunk of text
+    # if no seed text is specified, randomly select a chunk of text for each sample
+    if seed is None:
+        seeds = []
+        for _ in range(num_samples):
+            start_idx = random.randint(0, len(text) - max_len - 1)
+            seeds.append(text[start_idx:start_idx + max_len])
     else:
-        start_idx = random.randint(0, len(text) - max_len - 1)
-        seed = text[start_idx:start_idx + max_len]
-
-    sentence = seed
-    generated = sentence
-
-    while predict_more(generated):
-        # generate the input tensor
-        # from the last max_len characters generated so far
-        x = np.zeros((1, max_len, len(chars)))
-        for t, char in enumerate(sentence):
-            x[0, t, char_labels[char]] = 1.
+        seeds = [seed] * num_samples
+    seed_labels = np.stack([encode(s) for s in seeds])
+    if (seed_labels < 0).any():
+        raise Exception('Seed text contains characters not seen in the training text')
+
+    # pick up the latest trained weights
+    inf_model.set_weights(model.get_weights())
+
+    # the labels of everything generated so far (starting with the seed);
+    # each step only writes one new column, and we only turn the labels back
+    # into text once at the end
+    seed_len = seed_labels.shape[1]
+    generated = np.empty((num_samples, max(num_chars, seed_len)), dtype=np.int32)
+    generated[:, :seed_len] = seed_labels
+
+    for t in range(seed_len, num_chars):
+        if (t - seed_len) % max_len == 0:
+            # start again from empty states, like in training, and warm
+            # them up on all but the last of the latest max_len characters
+            # (the last one is fed in below)
+            states = [np.zeros((num_samples, 512), dtype=state_dtype) for _ in range(4)]
+            for w in range(t - max_len, t - 1):
+                _, *states = predict_step(tf.constant(generated[:, w:w+1]), states)
+
+        # this produces a probability distribution over characters for each
+        # sample, given only its latest character and the carried states
+        probs, *states = predict_step(tf.constant(generated[:, t-1:t]), states)
+
+        # sample the characters to use based on the predicted probabilities
+        generated[:, t] = sample(probs.numpy(), temperature)
+    return [''.join([labels_char[i] for i in row]) for row in generated.tolist()]
 
-        # this produces a probability distribution over characters
-        probs = model.predict(x, verbose=0)[0]
 
-        # sample the character to use based on the predicted probabilities
-        next_idx = sample(probs, temperature)
-        next_char = labels_char[next_idx]
-
-        generated += next_char
-        sentence = sentence[1:] + next_char
-    return generated
+def generate(temperature=0.35, seed=None, num_chars=100):
+    return generate_batch(temperature, seed, num_chars, num_samples=1)[0]
 
 
 # The _temperature_ controls how random we want the network to be. Lower temperatures favors more likely values, whereas higher temperatures introduce more and more randomness. At a high enough temperature, values will be chosen at random.
 # 
 # With this generation function we can modify how we train the network so that we see some output at each step:
 
-# In[36]:
+# In[37]:
 
 
 # serialize model to JSON
@@ -442,9 +588,23 @@ with open("text_gen_model.json", "w") as json_file:
     json_file.write(model_json)
 
 
-# In[37]:
+# In[38]:
 
 
+# feed the training data through a tf.data pipeline, so the next minibatches
+# are shuffled and staged in the background while the current one trains.
+# we shuffle the example indices (across the whole dataset, like model.fit's
+# own shuffling) rather than the examples themselves, and gather each batch
+# from a single in-memory copy of X and y
+X_t = tf.constant(X)
+y_t = tf.constant(y)
+dataset = (tf.data.Dataset.range(len(X))
+           .shuffle(len(X), reshuffle_each_iteration=True)
+           .batch(128, drop_remainder=True)
+           .map(lambda i: (tf.gather(X_t, i), tf.gather(y_t, i)),
+                num_parallel_calls=tf.data.AUTOTUNE)
+           .prefetch(tf.data.AUTOTUNE))
+
 # Let us train for 10 epochs
 epochs = 10
 for i in range(epochs):
@@ -452,7 +612,7 @@ for i in range(epochs):
 
     # set nb_epoch to 1 since we're iterating manually
     # comment this out if you just want to generate text
-    model.fit(X, y, batch_size=128, epochs=1)
+    model.fit(dataset, epochs=1)
 
     # preview
     for temp in [0.2, 0.5, 1., 1.2]:
@@ -460,7 +620,7 @@ for i in range(epochs):
         print('%s'%generate(temperature=temp))
     
     # serialize weights to HDF5
-    fname="text_gen_model_params_"+str(i)+".h5"
+    fname="text_gen_model_params_"+str(i)+".weights.h5"
     # save the model weights
     model.save_weights(fname)
     print("Saved model to disk")
@@ -468,18 +628,18 @@ for i in range(epochs):
 
 # That's about all there is to it. Let's try to generate one long sample passage with 2000 characters. We'll arbitrarily pick a temperature of 0.4, which seems to work decently well -- enough randomness without being incoherent. We'll also give it a seed this time (starting text): "Today, we are facing an important challenge"
 
-# In[38]:
+# In[39]:
 
 
 # Let us generate some text
 print('%s' % generate(temperature=0.4, seed='TurtlesInTime', num_chars=2000))
 
 
-# In[39]:
+# In[40]:
 
 
 # Let us load a saved model from disk
-from keras.models import model_from_json
+from tensorflow.keras.models import model_from_json
 # load json and create model
 json_file = open('text_gen_model.json', 'r')
 loaded_model_json = json_file.read()
@@ -487,13 +647,13 @@ json_file.close()
                  
 model = model_from_json(loaded_model_json)
 # load weights into new model
-fname="text_gen_model_params_9.h5"
+fname="text_gen_model_params_9.weights.h5"
 model.load_weights(fname)
 print("Loaded model from disk")
-model.compile(loss='categorical_crossentropy', optimizer='rmsprop')
+model.compile(loss='sparse_categorical_crossentropy', optimizer=Adam(learning_rate=1e-3))
 
 
-# In[40]:
+# In[41]:
 
 
 # generate text from the current model